@@ -1,24 +1,28 @@
 import streamlit as st
 from audio_recorder_streamlit import audio_recorder
 import speech_recognition as sr
-from gtts import gTTS
-import tempfile
-import os
-from medical_rag import MedicalRAGPipeline
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from medical_rag import MedicalRAGPipeline, TTS_WORKERS
+from speech_utils import synthesize_speech, join_audio, transcribe_local, transcribe_vosk, AUDIO_FORMAT, ASR_BACKEND
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import numpy as np
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def get_audio(text_hash: str, _text: str) -> bytes:
+    """Synthesize speech once per text hash so identical responses share one audio blob"""
+    return synthesize_speech(_text)
+
 class AudioHandler:
     def __init__(self):
         """Initialize AudioHandler with error handling"""
         self.recognizer = sr.Recognizer()
-        self.temp_dir = tempfile.mkdtemp()
-        logger.info(f"Initialized temporary directory at {self.temp_dir}")
 
     def process_audio_data(self, audio_bytes: bytes) -> Optional[str]:
         """Process audio data from audio-recorder-streamlit"""
@@ -26,13 +30,14 @@ class AudioHandler:
             return None
 
         try:
-            # Save audio bytes to temporary file
-            temp_file = os.path.join(self.temp_dir, "temp_audio.wav")
-            with open(temp_file, 'wb') as f:
-                f.write(audio_bytes)
+            # Transcribe the audio straight from memory
+            if ASR_BACKEND in ('whisper', 'vosk'):
+                transcribe = transcribe_local if ASR_BACKEND == 'whisper' else transcribe_vosk
+                text = transcribe(io.BytesIO(audio_bytes))
+                logger.info("Successfully transcribed audio")
+                return text or None
 
-            # Transcribe the audio
-            with sr.AudioFile(temp_file) as source:
+            with sr.AudioFile(io.BytesIO(audio_bytes)) as source:
                 audio_data = self.recognizer.record(source)
                 text = self.recognizer.recognize_google(audio_data)
                 logger.info("Successfully transcribed audio")
@@ -41,10 +46,10 @@ class AudioHandler:
         except Exception as e:
             logger.error(f"Error processing audio: {e}")
             return None
-        finally:
-            # Cleanup temporary file
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+
+    def transcribe_audio(self, audio_bytes: bytes) -> Optional[str]:
+        """Transcribe recorded audio, as MedicalRAGPipeline.process_audio_query expects"""
+        return self.process_audio_data(audio_bytes)
 
     def text_to_speech(self, text: str) -> Optional[bytes]:
         """Convert text to speech and return bytes"""
@@ -52,125 +57,142 @@ class AudioHandler:
             return None
 
         try:
-            # Create temporary file for audio
-            temp_file = os.path.join(self.temp_dir, "temp_speech.mp3")
-            tts = gTTS(text=text, lang='en')
-            tts.save(temp_file)
-
-            # Read file as bytes
-            with open(temp_file, 'rb') as f:
-                audio_bytes = f.read()
-
-            return audio_bytes
+            return get_audio(hashlib.blake2b(text.encode('utf-8')).hexdigest(), text)
 
         except Exception as e:
             logger.error(f"Error converting text to speech: {e}")
             return None
-        finally:
-            # Cleanup temporary file
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
 
-    def cleanup(self):
-        """Clean up temporary directory"""
+    def join_audio(self, chunks: List[bytes]) -> Optional[bytes]:
+        """Join per-sentence clips from text_to_speech into one clip"""
         try:
-            import shutil
-            shutil.rmtree(self.temp_dir)
-            logger.info("Cleaned up temporary files")
+            return join_audio(chunks)
         except Exception as e:
-            logger.error(f"Error cleaning up: {e}")
+            logger.error(f"Error joining audio clips: {e}")
+            return None
 
-class MedicalAssistantApp:
-    def __init__(self):
-        self.initialize_session_state()
-
-    def initialize_session_state(self):
-        """Initialize session state variables"""
-        if 'audio_handler' not in st.session_state:
-            st.session_state.audio_handler = AudioHandler()
-        
-        if 'pipeline' not in st.session_state:
+@st.cache_resource
+def get_audio_handler() -> AudioHandler:
+    """Create a single AudioHandler shared by all sessions"""
+    return AudioHandler()
+
+@st.cache_resource
+def get_pipeline():
+    """Build the pipeline and index once per process and share it across sessions"""
+    pipeline = MedicalRAGPipeline()
+    # Load data; create_index reuses an index prebuilt by `python -m scripts.build_index`
+    intents_data = pipeline.load_intents_data("intents.json")
+    documents = pipeline.load_diseases_data("diseases.json")
+    pipeline.create_index(documents)
+    # Queries scoring below the medical intent patterns are not sent to Gemini;
+    # the threshold is cached next to the index, so this only encodes on a miss
+    pipeline.calibrate_relevance(intents_data)
+    return pipeline, intents_data
+
+def initialize_session_state():
+    """Initialize session state variables"""
+    if 'audio_handler' not in st.session_state:
+        st.session_state.audio_handler = get_audio_handler()
+    
+    if 'pipeline' not in st.session_state:
+        try:
+            st.session_state.pipeline, st.session_state.intents_data = get_pipeline()
+        except Exception as e:
+            logger.error(f"Error initializing pipeline: {e}")
+            st.error("Error initializing the medical assistant. Please try refreshing the page.")
+
+@st.fragment
+def handle_text_input():
+    """Handle text input interactions"""
+    text_query = st.text_input("Enter your medical question:")
+    if st.button("Get Answer", key="text_button"):
+        if text_query:
             try:
-                st.session_state.pipeline = MedicalRAGPipeline(
-                    gemini_api_key=os.getenv("GEMINI_API_KEY")  # you can put thekey as well
+                response = st.session_state.pipeline.generate_response(
+                    text_query, 
+                    st.session_state.intents_data
                 )
-                # Load data and create index
-                documents = st.session_state.pipeline.load_diseases_data("diseases.json")
-                st.session_state.intents_data = st.session_state.pipeline.load_intents_data("intents.json")
-                st.session_state.pipeline.create_index(documents)
+                st.write("Response:", response)
+                
+                audio_bytes = st.session_state.audio_handler.text_to_speech(response)
+                if audio_bytes:
+                    st.audio(audio_bytes, format=AUDIO_FORMAT)
             except Exception as e:
-                logger.error(f"Error initializing pipeline: {e}")
-                st.error("Error initializing the medical assistant. Please try refreshing the page.")
-
-    def run(self):
-        st.title("Medical Assistant")
-        
-        # Create tabs
-        text_tab, audio_tab = st.tabs(["Text Input", "Audio Input"])
-
-        # Text Input Tab
-        with text_tab:
-            self.handle_text_input()
-
-        # Audio Input Tab
-        with audio_tab:
-            self.handle_audio_input()
-
-        # Add disclaimer
-        st.markdown("---")
-        st.markdown("""
-        **Disclaimer**: This medical assistant is for informational purposes only. 
-        Always consult healthcare professionals for medical advice, diagnosis, or treatment.
-        """)
-
-    def handle_text_input(self):
-        """Handle text input interactions"""
-        text_query = st.text_input("Enter your medical question:")
-        if st.button("Get Answer", key="text_button"):
-            if text_query:
-                try:
-                    response = st.session_state.pipeline.generate_response(
-                        text_query, 
-                        st.session_state.intents_data
-                    )
-                    st.write("Response:", response)
-                    
-                    audio_bytes = st.session_state.audio_handler.text_to_speech(response)
-                    if audio_bytes:
-                        st.audio(audio_bytes, format='audio/mp3')
-                except Exception as e:
-                    logger.error(f"Error processing text input: {e}")
-                    st.error("Error generating response. Please try again.")
-
-    def handle_audio_input(self):
-        """Handle audio input using audio-recorder-streamlit"""
-        st.write("Click the microphone to start recording")
-        audio_bytes = audio_recorder()
-
-        if audio_bytes:
-            try:
-                # Process the audio
-                text = st.session_state.audio_handler.process_audio_data(audio_bytes)
-                if text:
-                    st.write("You said:", text)
-                    
-                    # Generate response
-                    response = st.session_state.pipeline.generate_response(
+                logger.error(f"Error processing text input: {e}")
+                st.error("Error generating response. Please try again.")
+
+@st.fragment
+def handle_audio_input():
+    """Handle audio input using audio-recorder-streamlit"""
+    st.write("Click the microphone to start recording")
+    audio_bytes = audio_recorder()
+
+    if audio_bytes:
+        try:
+            # Process the audio
+            text = st.session_state.audio_handler.process_audio_data(audio_bytes)
+            if text:
+                st.write("You said:", text)
+                
+                # Stream the response and synthesize each sentence while Gemini writes the next
+                audio_handler = st.session_state.audio_handler
+                response_placeholder = st.empty()
+                audio_placeholder = st.empty()
+                sentences = []
+                audio_futures = []
+                audio_chunks = []
+                with ThreadPoolExecutor(max_workers=TTS_WORKERS) as executor:
+                    for sentence in st.session_state.pipeline.stream_response(
                         text,
                         st.session_state.intents_data
-                    )
-                    st.write("Response:", response)
+                    ):
+                        sentences.append(sentence)
+                        response_placeholder.write("Response: " + " ".join(sentences))
+                        audio_futures.append(executor.submit(audio_handler.text_to_speech, sentence))
+                        
+                        # Offer the leading sentences that are already synthesized
+                        ready = len(audio_chunks)
+                        while len(audio_chunks) < len(audio_futures) and audio_futures[len(audio_chunks)].done():
+                            audio_chunks.append(audio_futures[len(audio_chunks)].result())
+                        if len(audio_chunks) > ready and all(audio_chunks):
+                            audio_placeholder.audio(audio_handler.join_audio(audio_chunks), format=AUDIO_FORMAT)
                     
-                    # Convert response to speech
-                    audio_response = st.session_state.audio_handler.text_to_speech(response)
-                    if audio_response:
-                        st.audio(audio_response, format='audio/mp3')
+                    audio_chunks = [future.result() for future in audio_futures]
+                
+                # Convert response to speech
+                audio_response = audio_handler.join_audio(audio_chunks) if all(audio_chunks) else None
+                if audio_response:
+                    audio_placeholder.audio(audio_response, format=AUDIO_FORMAT)
                 else:
-                    st.error("Could not understand the audio. Please try again.")
-            except Exception as e:
-                logger.error(f"Error processing audio input: {e}")
-                st.error("Error processing audio. Please try again.")
+                    audio_placeholder.empty()
+            else:
+                st.error("Could not understand the audio. Please try again.")
+        except Exception as e:
+            logger.error(f"Error processing audio input: {e}")
+            st.error("Error processing audio. Please try again.")
+
+def main():
+    initialize_session_state()
+
+    st.title("Medical Assistant")
+    
+    # Create tabs
+    text_tab, audio_tab = st.tabs(["Text Input", "Audio Input"])
+
+    # Text Input Tab
+    with text_tab:
+        handle_text_input()
+
+    # Audio Input Tab
+    with audio_tab:
+        handle_audio_input()
+
+    # Add disclaimer
+    st.markdown("---")
+    st.markdown("""
+    **Disclaimer**: This medical assistant is for informational purposes only. 
+    Always consult healthcare professionals for medical advice, diagnosis, or treatment.
+    """)
 
 if __name__ == "__main__":
-    app = MedicalAssistantApp()
-    app.run()
+    main()
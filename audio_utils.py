@@ -1,28 +1,46 @@
 import sounddevice as sd
 import soundfile as sf
 import speech_recognition as sr
-from gtts import gTTS
+import webrtcvad
+from scipy.signal import resample_poly
+from math import gcd
+import io
 import os
-from datetime import datetime
+import queue
 import numpy as np
-import tempfile
 import logging
-from typing import Optional, Tuple
+from typing import Callable, List, Optional, Tuple, Union
+from speech_utils import (
+    synthesize_speech, join_audio, transcribe_local, transcribe_vosk,
+    new_stream_recognizer, finish_stream, TTS_BACKEND, ASR_BACKEND
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Voice activity detection used to end recordings automatically
+VAD_FRAME_MS = 20
+VAD_AGGRESSIVENESS = 2
+END_OF_UTTERANCE_MS = 800
+VAD_SAMPLE_RATES = (8000, 16000, 32000, 48000)
+
+# Speech models run at 16 kHz; 48 kHz is the fallback capture rate since
+# webrtcvad supports it and it resamples to 16 kHz by an integer factor
+ASR_SAMPLE_RATE = 16000
+FALLBACK_SAMPLE_RATE = 48000
+MAX_RECORD_SECONDS = 30
+
 class AudioHandler:
     def __init__(self, device=None):
         """Initialize AudioHandler with error recovery capabilities"""
         self.recognizer = sr.Recognizer()
         self.device = device
         self.setup_audio_device()
-        
-        # Create temporary directories for audio files
-        self.temp_dir = tempfile.mkdtemp()
-        logger.info(f"Initialized temporary directory at {self.temp_dir}")
+
+        # Capture buffer reused by every recording, sized for the highest capture rate
+        self._buf = np.empty(MAX_RECORD_SECONDS * FALLBACK_SAMPLE_RATE, dtype=np.int16)
+        self._write_idx = 0
 
     def setup_audio_device(self) -> None:
         """Setup audio device with fallback options"""
@@ -54,32 +72,127 @@ class AudioHandler:
                 logger.error("No working audio input devices found")
                 self.device = None
 
-    def record_audio(self, duration: int = 5, sample_rate: int = 44100) -> Optional[str]:
-        """Record audio with error handling and recovery"""
+    def _capture_rate(self, sample_rate: int) -> int:
+        """
+        Use the requested rate if both the device and the VAD support it, otherwise
+        the fallback rate (the recording is resampled to the requested rate afterwards)
+        """
+        if sample_rate not in VAD_SAMPLE_RATES:
+            logger.info(f"VAD does not support {sample_rate} Hz, recording at {FALLBACK_SAMPLE_RATE} Hz")
+            return FALLBACK_SAMPLE_RATE
+        try:
+            sd.check_input_settings(device=self.device, channels=1, dtype='int16', samplerate=sample_rate)
+            return sample_rate
+        except Exception:
+            logger.warning(f"Device does not support {sample_rate} Hz, recording at {FALLBACK_SAMPLE_RATE} Hz")
+            return FALLBACK_SAMPLE_RATE
+
+    def record_audio(self, duration: int = 10, sample_rate: int = ASR_SAMPLE_RATE) -> Optional[bytes]:
+        """
+        Record until the speaker stops talking (or for at most duration seconds)
+        and return the recording as FLAC bytes, with error handling and recovery
+        """
+        return self._record(duration, sample_rate)
+
+    def record_and_transcribe(self, duration: int = 10,
+                              sample_rate: int = ASR_SAMPLE_RATE) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Record like record_audio and return the recording with its transcript. With
+        the vosk backend speech frames are recognized while recording continues, so
+        the transcript is ready as soon as the utterance ends
+        """
+        if ASR_BACKEND != 'vosk' or self.device is None:
+            audio = self._record(duration, sample_rate)
+            return audio, self.transcribe_audio(audio) if audio else None
+
+        try:
+            # Load the model before capture starts; Vosk resamples from the capture rate itself
+            recognizer = new_stream_recognizer(self._capture_rate(sample_rate))
+        except Exception as e:
+            logger.error(f"Error creating Vosk recognizer: {e}")
+            return self._record(duration, sample_rate), None
+
+        audio = self._record(duration, sample_rate, recognizer.AcceptWaveform)
+        if not audio:
+            return None, None
+        try:
+            text = finish_stream(recognizer)
+            logger.info("Successfully transcribed audio using Vosk while recording")
+            return audio, text or None
+        except Exception as e:
+            logger.error(f"Error transcribing audio: {e}")
+            return audio, None
+
+    def _record(self, duration: int, sample_rate: int,
+                on_speech: Optional[Callable[[bytes], None]] = None) -> Optional[bytes]:
+        """
+        Capture from the input device until end of utterance, handing every frame
+        from the start of speech to on_speech as it arrives
+        """
         if self.device is None:
             logger.error("No valid input device available")
             return None
 
         try:
+            capture_rate = self._capture_rate(sample_rate)
             logger.info("Starting recording...")
-            recording = sd.rec(
-                int(duration * sample_rate),
-                samplerate=sample_rate,
+            frame_size = capture_rate * VAD_FRAME_MS // 1000
+            frames = queue.Queue()
+            self._write_idx = 0
+
+            def callback(indata, frame_count, time_info, status):
+                if status:
+                    logger.warning(f"Recording status: {status}")
+                end = self._write_idx + frame_count
+                if end > len(self._buf):
+                    raise sd.CallbackStop
+                self._buf[self._write_idx:end] = np.frombuffer(indata, dtype=np.int16)
+                frames.put((self._write_idx, end))
+                self._write_idx = end
+
+            # Consume frames while they are captured so recording stops as soon
+            # as the utterance ends instead of after a fixed duration
+            vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+            max_frames = min(duration, MAX_RECORD_SECONDS) * 1000 // VAD_FRAME_MS
+            frame_count = 0
+            speech_started = False
+            silent_frames = 0
+            with sd.RawInputStream(
+                samplerate=capture_rate,
+                blocksize=frame_size,
                 channels=1,
-                dtype='float32',
-                device=self.device
-            )
-            sd.wait()
-            
-            # Generate temporary file path
-            temp_file = os.path.join(self.temp_dir, f"input_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav")
-            
-            # Normalize audio data
-            recording = np.clip(recording, -1.0, 1.0)
+                dtype='int16',
+                device=self.device,
+                callback=callback
+            ):
+                while frame_count < max_frames:
+                    start, end = frames.get(timeout=1)
+                    frame_count += 1
+                    frame = self._buf[start:end].tobytes()
+                    if vad.is_speech(frame, capture_rate):
+                        speech_started = True
+                        silent_frames = 0
+                    elif speech_started:
+                        silent_frames += 1
+                        if silent_frames * VAD_FRAME_MS >= END_OF_UTTERANCE_MS:
+                            logger.info("End of utterance detected")
+                            break
+                    # Pauses between words are kept, the recognizer needs them
+                    if speech_started and on_speech is not None:
+                        on_speech(frame)
+
+            # A view into the capture buffer, handed to the encoder without a copy
+            recording = self._buf[:self._write_idx]
+            if capture_rate != sample_rate:
+                divisor = gcd(sample_rate, capture_rate)
+                recording = resample_poly(recording, sample_rate // divisor, capture_rate // divisor)
+                recording = np.clip(np.round(recording), -32768, 32767).astype(np.int16)
             
-            sf.write(temp_file, recording, sample_rate)
-            logger.info(f"Recording saved to {temp_file}")
-            return temp_file
+            # Lossless FLAC at the model rate keeps the upload as small as possible
+            buffer = io.BytesIO()
+            sf.write(buffer, recording, sample_rate, format='FLAC', subtype='PCM_16')
+            logger.info(f"Recorded {len(recording) / sample_rate:.1f}s of audio")
+            return buffer.getvalue()
             
         except Exception as e:
             logger.error(f"Error recording audio: {e}")
@@ -87,14 +200,25 @@ class AudioHandler:
             self.setup_audio_device()
             return None
 
-    def transcribe_audio(self, audio_file: str) -> Optional[str]:
-        """Transcribe audio with multiple fallback options"""
-        if not os.path.exists(audio_file):
-            logger.error(f"Audio file not found: {audio_file}")
+    def transcribe_audio(self, audio: Union[str, bytes]) -> Optional[str]:
+        """Transcribe an audio file path or in-memory recording with multiple fallback options"""
+        if isinstance(audio, bytes):
+            audio = io.BytesIO(audio)
+        elif not os.path.exists(audio):
+            logger.error(f"Audio file not found: {audio}")
             return None
 
         try:
-            with sr.AudioFile(audio_file) as source:
+            if ASR_BACKEND == 'whisper':
+                text = transcribe_local(audio)
+                logger.info("Successfully transcribed audio using Whisper")
+                return text or None
+            if ASR_BACKEND == 'vosk':
+                text = transcribe_vosk(audio)
+                logger.info("Successfully transcribed audio using Vosk")
+                return text or None
+
+            with sr.AudioFile(audio) as source:
                 audio_data = self.recognizer.record(source)
                 
                 # Try Google Speech Recognition first
@@ -116,24 +240,19 @@ class AudioHandler:
             logger.error(f"Error transcribing audio: {e}")
             return None
 
-    def text_to_speech(self, text: str) -> Optional[str]:
-        """Convert text to speech with fallback options"""
+    def text_to_speech(self, text: str) -> Optional[bytes]:
+        """Convert text to speech and return the audio bytes"""
         if not text:
             logger.error("No text provided for conversion")
             return None
 
         try:
-            # Generate temporary file path
-            temp_file = os.path.join(self.temp_dir, f"response_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3")
-            
-            # Try gTTS first
             try:
-                tts = gTTS(text=text, lang='en')
-                tts.save(temp_file)
-                logger.info("Successfully generated audio using gTTS")
-                return temp_file
+                audio_bytes = synthesize_speech(text)
+                logger.info(f"Successfully generated audio using {TTS_BACKEND}")
+                return audio_bytes
             except Exception as e:
-                logger.error(f"gTTS failed: {e}")
+                logger.error(f"{TTS_BACKEND} failed: {e}")
                 # Could implement fallback TTS here if needed
                 return None
                 
@@ -141,30 +260,27 @@ class AudioHandler:
             logger.error(f"Error converting text to speech: {e}")
             return None
 
-    def play_audio(self, audio_file: str) -> bool:
-        """Play audio with error handling"""
-        if not os.path.exists(audio_file):
-            logger.error(f"Audio file not found: {audio_file}")
+    def join_audio(self, chunks: List[bytes]) -> Optional[bytes]:
+        """Join per-sentence clips from text_to_speech into one clip"""
+        try:
+            return join_audio(chunks)
+        except Exception as e:
+            logger.error(f"Error joining audio clips: {e}")
+            return None
+
+    def play_audio(self, audio: Union[str, bytes]) -> bool:
+        """Play audio from a file path or in-memory bytes with error handling"""
+        if isinstance(audio, bytes):
+            audio = io.BytesIO(audio)
+        elif not os.path.exists(audio):
+            logger.error(f"Audio file not found: {audio}")
             return False
 
         try:
-            data, samplerate = sf.read(audio_file)
+            data, samplerate = sf.read(audio)
             sd.play(data, samplerate)
             sd.wait()
             return True
         except Exception as e:
             logger.error(f"Error playing audio: {e}")
             return False
-
-    def cleanup(self) -> None:
-        """Clean up temporary files"""
-        try:
-            import shutil
-            shutil.rmtree(self.temp_dir)
-            logger.info("Cleaned up temporary files")
-        except Exception as e:
-            logger.error(f"Error cleaning up temporary files: {e}")
-
-    def __del__(self):
-        """Destructor to ensure cleanup"""
-        self.cleanup()
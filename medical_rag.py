@@ -1,63 +1,311 @@
-import json
+import orjson
+import ijson
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import faiss
-from typing import List, Dict, Tuple, Optional, Any
+import torch
+import ahocorasick
+from typing import List, Dict, Tuple, Optional, Any, Iterator, Union
 import logging
 import google.generativeai as genai
 from dataclasses import dataclass
 import re
 import os
+import math
+import hashlib
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Common medical misspellings, corrected word by word in normalize_query
+_MISSPELLINGS = {
+    'canser': 'cancer',
+    'diabetis': 'diabetes',
+    'artritis': 'arthritis',
+    'highbloodpressure': 'hypertension',
+    'asma': 'asthma',
+    'hart': 'heart',
+    'stroke': 'stroke',
+    'alzheimers': 'alzheimer',
+    'highblood': 'hypertension',
+    'colesterol': 'cholesterol',
+    'anxiety': 'anxiety',
+    'depresion': 'depression',
+    'migrane': 'migraine'
+}
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_MISSPELLING_RE = re.compile(r'\b(' + '|'.join(map(re.escape, _MISSPELLINGS)) + r')\b')
+
+_EXIT_PATTERNS = (
+    'quit', 'exit', 'bye', 'goodbye', 'terminate', 'end', 'sign off',
+    'terminate the call', 'end call'
+)
+
+# Streamed responses are handed to TTS one sentence at a time
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+TTS_WORKERS = 4
+RETRIEVAL_WORKERS = 4
+
+# calibrate_relevance puts the threshold this far below the lowest best score of
+# any medical intent pattern, so every known in-domain question clears it
+RELEVANCE_MARGIN = 0.05
+
+GEMINI_MODEL = 'gemini-pro'
+
+# MiniLM's 384-d embeddings truncated and renormalized, cutting index size and
+# distance compute by a third. MiniLM is not Matryoshka-trained, so this trades an
+# unmeasured amount of recall for speed; set 384 to disable the truncation
+EMBEDDING_DIM = 256
+
+# Corpora smaller than this get a flat 8-bit index, IVF-PQ needs enough vectors to train
+IVF_MIN_DOCUMENTS = 1000
+IVF_NPROBE = 16
+# FastScan packs 4-bit PQ codes in blocks of 32 vectors, matching AVX2 register lanes
+PQ_BITS = 4
+PQ_BLOCK_SIZE = 32
+
+# FAISS indexes keyed by a hash of the encoder, index parameters and corpus,
+# prebuilt with `python -m scripts.build_index`
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", "index_cache")
+# IO_FLAG_MMAP only maps IVF inverted lists; IO_FLAG_MMAP_IFC (newer faiss) also maps
+# flat and scalar quantizer codes, without it those are read into private memory
+INDEX_READ_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+
+# Final answers kept per (normalized query, intent tag)
+RESPONSE_CACHE_SIZE = 1024
+
+# Let FAISS scan IVF probes on every core
+faiss.omp_set_num_threads(os.cpu_count() or 1)
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model() -> genai.GenerativeModel:
+    """
+    Configure Gemini from GEMINI_API_KEY and create the model once per process
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            gemini_api_key = os.getenv('GEMINI_API_KEY')
+            if not gemini_api_key:
+                raise ValueError("Gemini API key not provided")
+
+            genai.configure(api_key=gemini_api_key)
+            _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the background event loop shared by all sessions, starting it on first use
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+@lru_cache(maxsize=None)
+def load_json(path: str) -> Any:
+    """Parse a JSON file with orjson, once per process"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+# Int8 ONNX exports from `python -m scripts.export_onnx` are used when present
+ONNX_DIR = "onnx"
+ONNX_MODEL_FILE = "model_int8.onnx"
+
 @dataclass
 class Document:
     content: str
     metadata: Dict[str, Any]
 
+class OnnxEncoder:
+    """
+    Drop-in replacement for SentenceTransformer.encode running an int8
+    quantized ONNX export of the model on ONNX Runtime
+    """
+    def __init__(self, model_dir: str, model_file: str = ONNX_MODEL_FILE, max_length: int = 256,
+                 truncate_dim: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.max_length = max_length
+        self.truncate_dim = truncate_dim
+
+    def encode(self, sentences: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Encode sentences into mean-pooled, L2-normalized float32 embeddings"""
+        outputs = []
+        for start in range(0, len(sentences), batch_size):
+            tokens = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors='np'
+            )
+            feeds = {name: tokens[name].astype(np.int64) for name in self.input_names if name in tokens}
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # Mean pooling over the non-padding tokens
+            mask = tokens['attention_mask'][..., None].astype(np.float32)
+            outputs.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        embeddings = np.concatenate(outputs).astype(np.float32, copy=False)
+        if self.truncate_dim:
+            embeddings = np.ascontiguousarray(embeddings[:, :self.truncate_dim])
+        # all-MiniLM-L6-v2 ends with a Normalize layer, so match it (after truncation)
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+class EmbedBatcher:
+    """
+    Collect query encodes from concurrent sessions for a short window and run
+    them through the encoder as a single batch
+    """
+    def __init__(self, encoder: Any, max_wait: float = 0.02, max_batch_size: int = 32):
+        self.encoder = encoder
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def encode(self, text: str) -> np.ndarray:
+        """Encode a single text, blocking until its batch has run"""
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self.encoder.encode(
+                    texts,
+                    batch_size=len(texts),
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                )
+            except Exception as e:
+                logger.error("Error encoding batch of %d queries: %s", len(texts), e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
 class MedicalRAGPipeline:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', gemini_api_key: Optional[str] = None):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', use_onnx: Optional[bool] = None):
         """
-        Initialize the Medical RAG Pipeline with improved error handling
+        Initialize the Medical RAG Pipeline with improved error handling.
+        use_onnx forces (True) or disables (False) the int8 ONNX encoder; by
+        default it is used whenever an export exists
         """
         try:
-            self.encoder = SentenceTransformer(model_name)
-            self.index = None
-            self.documents = []
-            self.dimension = 384  # Default dimension for all-MiniLM-L6-v2
+            self.model_name = model_name
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            self.gpu_resources = None
+            self.index_on_gpu = False
             
-            # Initialize Gemini
-            if not gemini_api_key:
-                gemini_api_key = os.getenv('GEMINI_API_KEY')
+            onnx_model_dir = os.path.join(ONNX_DIR, model_name)
+            onnx_exported = os.path.exists(os.path.join(onnx_model_dir, ONNX_MODEL_FILE))
+            if use_onnx and not onnx_exported:
+                raise FileNotFoundError(
+                    f"ONNX encoder not found in {onnx_model_dir}, run `python -m scripts.export_onnx`"
+                )
             
-            if not gemini_api_key:
-                raise ValueError("Gemini API key not provided")
-                
-            genai.configure(api_key=gemini_api_key)
-            self.model = genai.GenerativeModel('gemini-pro')
+            if onnx_exported and use_onnx is not False:
+                self.encoder = OnnxEncoder(onnx_model_dir, truncate_dim=EMBEDDING_DIM)
+                # A re-export (e.g. for another --arch) changes the vectors, so identify the file
+                onnx_stat = os.stat(os.path.join(onnx_model_dir, ONNX_MODEL_FILE))
+                self.encoder_backend = f"onnx-int8:{onnx_stat.st_size}:{onnx_stat.st_mtime_ns}"
+                logger.info("Using int8 ONNX encoder from %s", onnx_model_dir)
+            else:
+                # normalize_embeddings=True renormalizes after the truncation
+                self.encoder = SentenceTransformer(model_name, device=self.device, truncate_dim=EMBEDDING_DIM)
+                self.encoder_backend = "sentence-transformers"
+            self.embed_batcher = EmbedBatcher(self.encoder)
+            self._embed_cached = lru_cache(maxsize=4096)(self._embed_uncached)
+            self._response_cache: Dict[Tuple[str, Optional[str]], str] = {}
+            self._response_cache_lock = threading.Lock()
+            self._intents_data = None
+            self._intent_automaton = None
+            # Retrieval blocks on the encoder and FAISS, so it runs here instead of on the event loop
+            self._retrieval_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+            self.index = None
+            self.index_key = None
+            self.documents = []
+            self._contents = np.array([], dtype=object)
+            self.dimension = EMBEDDING_DIM
             
             # Add exit patterns
-            self.exit_patterns = {
-                'quit', 'exit', 'bye', 'goodbye', 'terminate', 'end', 'sign off',
-                'terminate the call', 'sign off', 'end call'
-            }
+            self.exit_patterns = set(_EXIT_PATTERNS)
+            # One word-boundary alternation, longest phrases first so they win over their prefixes
+            self._exit_re = re.compile(r'\b(' + '|'.join(
+                map(re.escape, sorted(self.exit_patterns, key=len, reverse=True))
+            ) + r')\b')
             
             # Medical disclaimer
             self.medical_disclaimer = (
                 "\nDisclaimer: This information is for educational purposes only. "
                 "Please consult a healthcare professional for medical advice, diagnosis, or treatment."
             )
+            self.exit_message = (
+                "Thank you for using our medical assistance service. "
+                "Remember to consult healthcare professionals for medical advice. Goodbye!"
+            )
+            self.error_message = (
+                "I apologize, but I'm having trouble generating a response. "
+                "Please try again or consult a healthcare professional for medical advice."
+            )
+            self.no_context_message = "I don't have information on that."
+            # Set by calibrate_relevance; until then every search result counts as relevant
+            self.min_relevance_score = None
             
             logger.info("Successfully initialized Medical RAG Pipeline")
             
         except Exception as e:
-            logger.error(f"Error initializing Medical RAG Pipeline: {e}")
+            logger.error("Error initializing Medical RAG Pipeline: %s", e)
             raise
 
+    @property
+    def model(self) -> genai.GenerativeModel:
+        """
+        Gemini client shared by every pipeline in the process, created on first
+        generation so building the index needs no API key
+        """
+        return get_model()
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     def load_diseases_data(self, diseases_path: str) -> List[Document]:
         """
@@ -67,46 +315,45 @@ class MedicalRAGPipeline:
             if not os.path.exists(diseases_path):
                 raise FileNotFoundError(f"Diseases data file not found: {diseases_path}")
                 
-            with open(diseases_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
             documents = []
-            for disease in data.get('diseases', []):
-                try:
-                    # Create comprehensive document for each disease
-                    content_parts = []
+            # Stream one disease object at a time instead of materializing the whole tree
+            with open(diseases_path, 'rb') as f:
+                for disease in ijson.items(f, 'diseases.item'):
+                    try:
+                        # Create comprehensive document for each disease
+                        content_parts = []
                     
-                    if 'tag' in disease:
-                        content_parts.append(f"{disease['tag']}: {disease.get(disease['tag'], '')}")
-                    if 'symptoms' in disease:
-                        content_parts.append(f"Symptoms: {disease['symptoms']}")
-                    if 'treatment' in disease:
-                        content_parts.append(f"Treatment: {disease['treatment']}")
-                    if 'types' in disease:
-                        content_parts.append(f"Types: {disease['types']}")
-                    if 'prevention' in disease:
-                        content_parts.append(f"Prevention: {disease['prevention']}")
+                        if 'tag' in disease:
+                            content_parts.append(f"{disease['tag']}: {disease.get(disease['tag'], '')}")
+                        if 'symptoms' in disease:
+                            content_parts.append(f"Symptoms: {disease['symptoms']}")
+                        if 'treatment' in disease:
+                            content_parts.append(f"Treatment: {disease['treatment']}")
+                        if 'types' in disease:
+                            content_parts.append(f"Types: {disease['types']}")
+                        if 'prevention' in disease:
+                            content_parts.append(f"Prevention: {disease['prevention']}")
                     
-                    content = "\n".join(content_parts)
+                        content = "\n".join(content_parts)
                     
-                    doc = Document(
-                        content=content,
-                        metadata={'tag': disease.get('tag', 'unknown')}
-                    )
-                    documents.append(doc)
+                        doc = Document(
+                            content=content,
+                            metadata={'tag': disease.get('tag', 'unknown')}
+                        )
+                        documents.append(doc)
                     
-                except Exception as e:
-                    logger.error(f"Error processing disease entry: {e}")
-                    continue
+                    except Exception as e:
+                        logger.error("Error processing disease entry: %s", e)
+                        continue
             
             if not documents:
                 raise ValueError("No valid disease documents were created")
                 
-            logger.info(f"Successfully loaded {len(documents)} disease documents")
+            logger.info("Successfully loaded %d disease documents", len(documents))
             return documents
             
         except Exception as e:
-            logger.error(f"Error loading diseases data: {e}")
+            logger.error("Error loading diseases data: %s", e)
             raise
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
@@ -118,19 +365,122 @@ class MedicalRAGPipeline:
             if not os.path.exists(intents_path):
                 raise FileNotFoundError(f"Intents data file not found: {intents_path}")
                 
-            with open(intents_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_json(intents_path)
             
             if 'intents' not in data or not data['intents']:
                 raise ValueError("No intents found in the data file")
                 
-            logger.info(f"Successfully loaded intents data with {len(data['intents'])} intents")
+            # Match all intent patterns against a query in a single scan
+            self._intent_automaton = self._build_intent_automaton(data)
+            self._intents_data = data
+                
+            logger.info("Successfully loaded intents data with %d intents", len(data['intents']))
             return data
             
         except Exception as e:
-            logger.error(f"Error loading intents data: {e}")
+            logger.error("Error loading intents data: %s", e)
             raise
 
+    def _index_params(self, num_vectors: int) -> Dict[str, Any]:
+        """
+        Choose the index type and its parameters for a corpus of num_vectors
+        """
+        if self._gpu_available():
+            # index_cpu_to_gpu cannot clone SQ8 or FastScan indexes, exact search can move
+            return {'type': 'FlatIP'}
+        if num_vectors < IVF_MIN_DOCUMENTS:
+            # 8-bit codes cut memory traffic 4x; queries stay float32
+            return {'type': 'SQ8'}
+        return {
+            'type': 'IVFPQFastScan',
+            'nlist': min(256, 4 * int(math.sqrt(num_vectors))),
+            'm': self.dimension // 8,
+            'bits': PQ_BITS,
+            'bbs': PQ_BLOCK_SIZE,
+            'nprobe': IVF_NPROBE
+        }
+
+    def _build_index(self, embeddings: np.ndarray) -> faiss.Index:
+        """
+        Build an empty inner product index suited to the corpus size, trained if needed
+        """
+        params = self._index_params(len(embeddings))
+        if params['type'] == 'FlatIP':
+            return faiss.IndexFlatIP(self.dimension)
+        if params['type'] == 'SQ8':
+            index = faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(embeddings)
+            return index
+
+        quantizer = faiss.IndexFlatIP(self.dimension)
+        index = faiss.IndexIVFPQFastScan(
+            quantizer, self.dimension, params['nlist'], params['m'], params['bits'],
+            faiss.METRIC_INNER_PRODUCT, params['bbs']
+        )
+        index.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+        index.nprobe = params['nprobe']
+        return index
+
+    def _gpu_available(self) -> bool:
+        """
+        Check for a CUDA device and a GPU build of faiss (faiss-gpu instead of faiss-cpu)
+        """
+        return self.device == 'cuda' and hasattr(faiss, 'StandardGpuResources')
+
+    def _to_device(self, index: faiss.Index) -> faiss.Index:
+        """
+        Move the index to the GPU when one is available, keeping it on the CPU otherwise
+        """
+        self.index_on_gpu = False
+        if not self._gpu_available():
+            return index
+
+        try:
+            if self.gpu_resources is None:
+                self.gpu_resources = faiss.StandardGpuResources()
+            gpu_index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, index)
+            self.index_on_gpu = True
+            return gpu_index
+        except Exception as e:
+            logger.warning("Keeping FAISS index on CPU: %s", e)
+            return index
+
+    def _set_documents(self, documents: List[Document]) -> None:
+        """
+        Keep the indexed documents along with a parallel content array for search
+        """
+        self.documents = documents
+        self._contents = np.array([doc.content for doc in documents], dtype=object)
+
+    def _index_cache_key(self, texts: List[str]) -> str:
+        """
+        Hash everything that decides the index contents into its cache key: the
+        encoder and its backend, the embedding size, the index parameters and
+        the document texts
+        """
+        params = sorted(self._index_params(len(texts)).items())
+        digest = hashlib.blake2b(
+            f"{self.model_name}:{self.encoder_backend}:{self.dimension}:{params}".encode('utf-8'),
+            digest_size=8
+        )
+        for text in texts:
+            digest.update(b'\0')
+            digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _write_index_cache(self, index: faiss.Index, index_file: str) -> None:
+        """Persist the index for the next start, a failure only costs a rebuild"""
+        try:
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            temp_file = f"{index_file}.{os.getpid()}.tmp"
+            faiss.write_index(index, temp_file)
+            os.replace(temp_file, index_file)
+        except Exception as e:
+            logger.warning("Could not write index cache: %s", e)
+
     def create_index(self, documents: List[Document]) -> None:
         """
         Create FAISS index with error handling
@@ -139,19 +489,37 @@ class MedicalRAGPipeline:
             if not documents:
                 raise ValueError("No documents provided for indexing")
                 
-            # Convert documents to embeddings
+            # The index is cached on disk under a hash of the encoder, index parameters and corpus
             texts = [doc.content for doc in documents]
-            embeddings = self.encoder.encode(texts)
+            index_key = self._index_cache_key(texts)
+            index_file = os.path.join(INDEX_CACHE_DIR, f"{index_key}.faiss")
+            
+            if os.path.exists(index_file):
+                index = faiss.read_index(index_file, INDEX_READ_FLAGS)
+                logger.info("Loaded cached FAISS index %s", index_file)
+            else:
+                # Unit vectors make inner product rank exactly like L2 distance
+                embeddings = np.ascontiguousarray(self.encoder.encode(
+                    texts,
+                    batch_size=128,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                ), dtype=np.float32)
+                
+                # Initialize FAISS index
+                index = self._build_index(embeddings)
+                index.add(embeddings)
+                self._write_index_cache(index, index_file)
             
-            # Initialize FAISS index
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.index.add(np.array(embeddings).astype('float32'))
-            self.documents = documents
+            self.index = self._to_device(index)
+            self.index_key = index_key
+            self._set_documents(documents)
             
-            logger.info(f"Successfully created FAISS index with {len(documents)} documents")
+            logger.info("Successfully created FAISS index with %d documents", len(documents))
             
         except Exception as e:
-            logger.error(f"Error creating index: {e}")
+            logger.error("Error creating index: %s", e)
             raise
 
     def normalize_query(self, query: str) -> str:
@@ -159,34 +527,14 @@ class MedicalRAGPipeline:
         Normalize query with improved handling
         """
         try:
-            # Remove special characters and convert to lowercase
-            query = re.sub(r'[^\w\s]', '', query.lower())
-            
-            # Handle common medical misspellings
-            misspellings = {
-                'canser': 'cancer',
-                'diabetis': 'diabetes',
-                'artritis': 'arthritis',
-                'highbloodpressure': 'hypertension',
-                'asma': 'asthma',
-                'hart': 'heart',
-                'stroke': 'stroke',
-                'alzheimers': 'alzheimer',
-                'highblood': 'hypertension',
-                'colesterol': 'cholesterol',
-                'anxiety': 'anxiety',
-                'depresion': 'depression',
-                'migrane': 'migraine'
-            }
-            
-            # Split query into words and correct each word if it's misspelled
-            words = query.split()
-            corrected_words = [misspellings.get(word, word) for word in words]
+            # Remove special characters, convert to lowercase and collapse whitespace
+            query = ' '.join(_PUNCT_RE.sub('', query.lower()).split())
             
-            return ' '.join(corrected_words)
+            # Correct common medical misspellings word by word in a single pass
+            return _MISSPELLING_RE.sub(lambda match: _MISSPELLINGS[match.group(1)], query)
             
         except Exception as e:
-            logger.error(f"Error normalizing query: {e}")
+            logger.error("Error normalizing query: %s", e)
             return query
 
     def is_exit_request(self, query: str) -> bool:
@@ -194,13 +542,26 @@ class MedicalRAGPipeline:
         Check if query is an exit request
         """
         try:
-            normalized_query = query.lower().strip()
-            return any(exit_pattern in normalized_query for exit_pattern in self.exit_patterns)
+            return self._exit_re.search(query.lower()) is not None
         except Exception as e:
-            logger.error(f"Error checking exit request: {e}")
+            logger.error("Error checking exit request: %s", e)
             return False
 
-    def search(self, query: str, k: int = 3) -> List[Tuple[Document, float]]:
+    def _embed_uncached(self, text: str) -> np.ndarray:
+        """Encode a query through the batcher"""
+        embedding = self.embed_batcher.encode(text)
+        # Cached arrays are shared between callers
+        embedding.flags.writeable = False
+        return embedding
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Encode a query, reusing cached embeddings and batching misses together
+        with concurrent queries from other sessions
+        """
+        return self._embed_cached(text)
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[str, float]]:
         """
         Search the index with improved error handling
         """
@@ -208,73 +569,283 @@ class MedicalRAGPipeline:
             if not self.index:
                 raise ValueError("Index not initialized")
                 
-            # Encode query
-            query_embedding = self.encoder.encode([query])
+            # Encode query as a (1, d) view of the cached embedding, copied only if not float32
+            query_embedding = np.ascontiguousarray(self.embed(query)[None, :], dtype=np.float32)
             
-            # Search index
-            distances, indices = self.index.search(
-                np.array(query_embedding).astype('float32'), k
-            )
+            # Search index, higher scores are more similar
+            scores, indices = self.index.search(query_embedding, k)
             
-            # Return documents and scores
-            results = []
-            for idx, distance in zip(indices[0], distances[0]):
-                if 0 <= idx < len(self.documents):
-                    results.append((self.documents[idx], float(distance)))
-                else:
-                    logger.warning(f"Invalid document index: {idx}")
+            # FAISS pads with -1 when fewer than k documents match
+            valid = indices[0] >= 0
+            hits = self._contents[indices[0][valid]]
+            
+            # Return document contents and scores
+            return list(zip(hits.tolist(), scores[0][valid].tolist()))
+            
+        except Exception as e:
+            logger.error("Error during search: %s", e)
+            raise
+
+    def search_batch(self, queries: List[str], k: int = 3) -> List[List[Tuple[str, float]]]:
+        """
+        Search the index for several queries with one batched encode and one FAISS call
+        """
+        try:
+            if not self.index:
+                raise ValueError("Index not initialized")
+            if not queries:
+                return []
+                
+            # Encode all queries in one forward pass
+            query_embeddings = np.ascontiguousarray(self.encoder.encode(
+                queries,
+                batch_size=32,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            ), dtype=np.float32)
+            
+            # One search call amortizes IVF probe assignment across the batch
+            scores, indices = self.index.search(query_embeddings, k)
             
+            results = []
+            for row_scores, row_indices in zip(scores, indices):
+                valid = row_indices >= 0
+                results.append(list(zip(self._contents[row_indices[valid]].tolist(), row_scores[valid].tolist())))
             return results
             
         except Exception as e:
-            logger.error(f"Error during search: {e}")
+            logger.error("Error during batch search: %s", e)
             raise
 
-    @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=4))
-    def generate_response(self, query: str, intents_data: Dict) -> str:
+    @staticmethod
+    def _build_intent_automaton(intents_data: Dict) -> Optional[ahocorasick.Automaton]:
         """
-        Generate response with retry mechanism and improved error handling
+        Build one Aho-Corasick automaton over every lowercased intent pattern,
+        each mapped to the position of its intent
+        """
+        automaton = ahocorasick.Automaton()
+        for i, intent in enumerate(intents_data.get('intents', [])):
+            for pattern in intent.get('patterns', []):
+                pattern = pattern.lower()
+                # Keep the earliest intent when several share a pattern
+                if pattern and pattern not in automaton:
+                    automaton.add_word(pattern, (i, pattern))
+        if not len(automaton):
+            return None
+        automaton.make_automaton()
+        return automaton
+
+    def _match_intent(self, normalized_query: str, intents_data: Dict) -> Optional[Dict]:
+        """
+        Find the first intent with a pattern contained in the normalized query
+        """
+        if intents_data is self._intents_data:
+            automaton = self._intent_automaton
+        else:
+            automaton = self._build_intent_automaton(intents_data)
+        if automaton is None:
+            return None
+
+        # One pass over the query; the earliest intent in the file wins as before
+        first_match = min((i for _, (i, _) in automaton.iter(normalized_query)), default=None)
+        if first_match is None:
+            return None
+        return intents_data['intents'][first_match]
+
+    def _skips_llm(self, normalized_query: str, matching_intent: Optional[Dict]) -> bool:
+        """
+        Check if the query is exactly a pattern of a skip_llm intent, so the
+        canned response answers it on its own
+        """
+        if not (matching_intent and matching_intent.get('skip_llm') and matching_intent.get('responses')):
+            return False
+        # Intents match on substrings ("hi" in "this"), so require the whole query
+        return any(
+            self.normalize_query(pattern) == normalized_query
+            for pattern in matching_intent.get('patterns', [])
+        )
+
+    def calibrate_relevance(self, intents_data: Dict) -> Optional[float]:
+        """
+        Derive the relevance threshold from this corpus and index: search every
+        medical (non skip_llm) intent pattern, which are known in-domain questions,
+        and set the threshold RELEVANCE_MARGIN below the lowest best score. The
+        result is cached next to the index, keyed on the index and the intents
+        """
+        try:
+            if not self.index_key:
+                raise ValueError("Index not initialized")
+                
+            intents_hash = hashlib.blake2b(
+                orjson.dumps(intents_data, option=orjson.OPT_SORT_KEYS), digest_size=8
+            ).hexdigest()
+            threshold_file = os.path.join(INDEX_CACHE_DIR, f"{self.index_key}.{intents_hash}.relevance.json")
+            if os.path.exists(threshold_file):
+                with open(threshold_file, 'rb') as f:
+                    self.min_relevance_score = orjson.loads(f.read())['min_relevance_score']
+                logger.info("Loaded relevance threshold %.3f from %s", self.min_relevance_score, threshold_file)
+                return self.min_relevance_score
+                
+            patterns = [
+                self.normalize_query(pattern)
+                for intent in intents_data.get('intents', []) if not intent.get('skip_llm')
+                for pattern in intent.get('patterns', [])
+            ]
+            best_scores = [results[0][1] for results in self.search_batch(patterns, k=1) if results]
+            if not best_scores:
+                logger.warning("No intent patterns to calibrate the relevance threshold on")
+                return None
+                
+            # Scores come from the same quantized, truncated index the queries use
+            self.min_relevance_score = float(min(best_scores) - RELEVANCE_MARGIN)
+            logger.info(
+                "Relevance threshold %.3f from %d intent patterns (scores %.3f to %.3f)",
+                self.min_relevance_score, len(best_scores), min(best_scores), max(best_scores)
+            )
+            
+            try:
+                os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+                temp_file = f"{threshold_file}.{os.getpid()}.tmp"
+                with open(temp_file, 'wb') as f:
+                    f.write(orjson.dumps({'min_relevance_score': self.min_relevance_score}))
+                os.replace(temp_file, threshold_file)
+            except Exception as e:
+                logger.warning("Could not write relevance threshold cache: %s", e)
+            return self.min_relevance_score
+            
+        except Exception as e:
+            logger.error("Error calibrating relevance threshold: %s", e)
+            raise
+
+    def _is_relevant(self, search_results: List[Tuple[str, float]]) -> bool:
+        """
+        Check if the best retrieved document is similar enough to answer from
+        """
+        if not search_results:
+            return False
+        return self.min_relevance_score is None or search_results[0][1] >= self.min_relevance_score
+
+    def _fallback_response(self, matching_intent: Optional[Dict]) -> str:
+        """
+        Answer a query without relevant context from its medical intent when one
+        matched; skip_llm intents only match here on substrings, so they are ignored
+        """
+        if matching_intent and not matching_intent.get('skip_llm') and matching_intent.get('responses'):
+            return matching_intent['responses'][0]
+        return self.no_context_message
+
+    def _needs_retrieval(self, query: str, normalized_query: str, intents_data: Dict) -> bool:
+        """
+        Check if a query will reach Gemini rather than being answered as an exit,
+        a skip_llm intent or a cached response
+        """
+        if self.is_exit_request(query):
+            return False
+        matching_intent = self._match_intent(normalized_query, intents_data)
+        if self._skips_llm(normalized_query, matching_intent):
+            return False
+        cache_key = (normalized_query, matching_intent.get('tag') if matching_intent else None)
+        return cache_key not in self._response_cache
+
+    def _format_prompt(self, query: str, search_results: List[Tuple[str, float]]) -> str:
+        """
+        Build the Gemini prompt from already retrieved search results
+        """
+        # Create context from search results
+        context = "\n\n".join([content for content, _ in search_results])
+        
+        # Generate prompt
+        prompt = f"""As a medical assistant, provide a clear and concise answer to the following question using the provided context. 
+        Focus on accuracy and avoid repetition.
+
+        Context:
+        {context}
+
+        Question: {query}
+
+        Guidelines:
+        1. Be concise and avoid repeating information
+        2. If information is not available in the context, acknowledge that
+        3. For symptoms or serious conditions, recommend consulting a healthcare provider
+        4. Ensure the response is clear and well-structured
+        5. If this is an emergency condition, emphasize seeking immediate medical attention
+        """
+        
+        return prompt
+
+    def _cache_response(self, key: Tuple[str, Optional[str]], response: str) -> None:
+        """Remember a final response, evicting the oldest entry when full"""
+        with self._response_cache_lock:
+            if len(self._response_cache) >= RESPONSE_CACHE_SIZE:
+                self._response_cache.pop(next(iter(self._response_cache)))
+            self._response_cache[key] = response
+
+    def _stream_text(self, prompt: str) -> Iterator[str]:
+        """
+        Stream Gemini text chunks generated on the shared event loop into the calling thread
+        """
+        chunks = queue.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                response = await self.model.generate_content_async(prompt, stream=True)
+                async for chunk in response:
+                    chunks.put(chunk.text)
+            finally:
+                chunks.put(done)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        # Surface any error raised while streaming
+        future.result()
+
+    async def generate_response_async(self, query: str, intents_data: Dict,
+                                      search_results: Optional[List[Tuple[str, float]]] = None) -> str:
+        """
+        Generate response on the shared event loop with improved error handling,
+        reusing search_results when retrieval has already been done in a batch
         """
         try:
             # Check for exit request
             if self.is_exit_request(query):
-                return "Thank you for using our medical assistance service. Remember to consult healthcare professionals for medical advice. Goodbye!"
+                return self.exit_message
 
             # Normalize query
             normalized_query = self.normalize_query(query)
             
-            # Search for relevant documents
-            search_results = self.search(normalized_query)
+            # Find matching intent
+            matching_intent = self._match_intent(normalized_query, intents_data)
             
-            # Create context from search results
-            context = "\n\n".join([doc.content for doc, _ in search_results])
+            # Greetings and sign offs are answered from intents.json alone
+            if self._skips_llm(normalized_query, matching_intent):
+                return matching_intent['responses'][0] + self.medical_disclaimer
             
-            # Find matching intent
-            matching_intent = None
-            for intent in intents_data.get('intents', []):
-                if any(pattern.lower() in normalized_query for pattern in intent.get('patterns', [])):
-                    matching_intent = intent
-                    break
+            # Repeated questions skip Gemini entirely
+            cache_key = (normalized_query, matching_intent.get('tag') if matching_intent else None)
+            cached_response = self._response_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
             
-            # Generate prompt
-            prompt = f"""As a medical assistant, provide a clear and concise answer to the following question using the provided context. 
-            Focus on accuracy and avoid repetition.
-
-            Context:
-            {context}
-
-            Question: {query}
-
-            Guidelines:
-            1. Be concise and avoid repeating information
-            2. If information is not available in the context, acknowledge that
-            3. For symptoms or serious conditions, recommend consulting a healthcare provider
-            4. Ensure the response is clear and well-structured
-            5. If this is an emergency condition, emphasize seeking immediate medical attention
-            """
+            # Retrieve context off the event loop, only for queries that need Gemini
+            if search_results is None:
+                search_results = await asyncio.get_running_loop().run_in_executor(
+                    self._retrieval_pool, self.search, normalized_query
+                )
+            
+            # Without relevant context there is nothing to ground Gemini's answer in
+            if not self._is_relevant(search_results):
+                return self._fallback_response(matching_intent) + self.medical_disclaimer
+            
+            prompt = self._format_prompt(query, search_results)
             
             # Generate response using Gemini
-            response = self.model.generate_content(prompt)
+            response = await self.model.generate_content_async(prompt)
             final_response = response.text.strip()
             
             # Add intent response if available
@@ -286,14 +857,121 @@ class MedicalRAGPipeline:
             # Add medical disclaimer
             final_response += self.medical_disclaimer
             
+            self._cache_response(cache_key, final_response)
             return final_response
             
         except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return ("I apologize, but I'm having trouble generating a response. "
-                   "Please try again or consult a healthcare professional for medical advice.")
+            logger.error("Error generating response: %s", e)
+            return self.error_message
+
+    @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=4))
+    def generate_response(self, query: str, intents_data: Dict) -> str:
+        """
+        Generate response with retry mechanism and improved error handling
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.generate_response_async(query, intents_data), get_event_loop()
+        ).result()
+
+    def process_batch(self, queries: List[str], intents_data: Dict) -> List[str]:
+        """
+        Answer several queries concurrently, returning responses in query order
+        """
+        # Retrieve context with one batched encode and search, only for queries that reach Gemini
+        normalized_queries = [self.normalize_query(query) for query in queries]
+        to_search = [
+            i for i, (query, normalized_query) in enumerate(zip(queries, normalized_queries))
+            if self._needs_retrieval(query, normalized_query, intents_data)
+        ]
+        batch_results = [None] * len(queries)
+        try:
+            for i, search_results in zip(to_search, self.search_batch([normalized_queries[i] for i in to_search])):
+                batch_results[i] = search_results
+        except Exception as e:
+            # Each query then retrieves on its own and reports its own error
+            logger.error("Error during batch retrieval, searching per query: %s", e)
+
+        async def gather_responses():
+            return await asyncio.gather(*(
+                self.generate_response_async(query, intents_data, search_results)
+                for query, search_results in zip(queries, batch_results)
+            ))
+
+        return asyncio.run_coroutine_threadsafe(gather_responses(), get_event_loop()).result()
+
+    def stream_response(self, query: str, intents_data: Dict) -> Iterator[str]:
+        """
+        Generate the same response as generate_response, yielding it sentence by
+        sentence while Gemini is still streaming the rest
+        """
+        try:
+            # Check for exit request
+            if self.is_exit_request(query):
+                yield self.exit_message
+                return
+
+            # Normalize query
+            normalized_query = self.normalize_query(query)
+
+            # Find matching intent
+            matching_intent = self._match_intent(normalized_query, intents_data)
+
+            # Greetings and sign offs are answered from intents.json alone
+            if self._skips_llm(normalized_query, matching_intent):
+                yield matching_intent['responses'][0]
+                yield self.medical_disclaimer.strip()
+                return
+
+            # Serve a previously generated answer in one piece
+            cache_key = (normalized_query, matching_intent.get('tag') if matching_intent else None)
+            cached_response = self._response_cache.get(cache_key)
+            if cached_response is not None:
+                yield cached_response
+                return
+
+            # Retrieve context only for queries that need Gemini
+            search_results = self.search(normalized_query)
+
+            # Without relevant context there is nothing to ground Gemini's answer in
+            if not self._is_relevant(search_results):
+                yield self._fallback_response(matching_intent)
+                yield self.medical_disclaimer.strip()
+                return
+
+            prompt = self._format_prompt(query, search_results)
+
+            # Yield every complete sentence as soon as its boundary arrives
+            chunks = []
+            pending = ""
+            for chunk in self._stream_text(prompt):
+                chunks.append(chunk)
+                pending += chunk
+                *sentences, pending = _SENTENCE_END_RE.split(pending)
+                yield from sentences
+            if pending.strip():
+                yield pending.strip()
+
+            # Raw chunks keep Gemini's paragraph breaks and markdown, as generate_response returns them
+            final_response = "".join(chunks).strip()
+
+            # Add intent response if available
+            if matching_intent and 'responses' in matching_intent:
+                intent_response = matching_intent['responses'][0]
+                if intent_response not in final_response:
+                    final_response = f"{final_response}\n\n{intent_response}"
+                    yield intent_response
+
+            # Add medical disclaimer
+            yield self.medical_disclaimer.strip()
+
+            # Cache the assembled answer in the same form generate_response uses
+            self._cache_response(cache_key, final_response + self.medical_disclaimer)
+
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            yield self.error_message
 
-    def process_audio_query(self, audio_handler: Any, audio_file: str, intents_data: Dict) -> Optional[Dict]:
+    def process_audio_query(self, audio_handler: Any, audio_file: Union[str, bytes], intents_data: Dict) -> Optional[Dict]:
         """
         Process audio query with improved error handling
         """
@@ -304,11 +982,21 @@ class MedicalRAGPipeline:
                 logger.error("Could not transcribe audio")
                 return None
 
-            # Generate text response
-            text_response = self.generate_response(query, intents_data)
+            # Synthesize each sentence while Gemini is still generating the next ones
+            sentences = []
+            with ThreadPoolExecutor(max_workers=TTS_WORKERS) as executor:
+                audio_futures = []
+                for sentence in self.stream_response(query, intents_data):
+                    sentences.append(sentence)
+                    audio_futures.append(executor.submit(audio_handler.text_to_speech, sentence))
+                audio_chunks = [future.result() for future in audio_futures]
+            text_response = " ".join(sentences)
 
             # Convert response to audio
-            audio_response = audio_handler.text_to_speech(text_response)
+            if not all(audio_chunks):
+                logger.error("Could not convert response to speech")
+                return None
+            audio_response = audio_handler.join_audio(audio_chunks)
             if not audio_response:
                 logger.error("Could not convert response to speech")
                 return None
@@ -320,5 +1008,5 @@ class MedicalRAGPipeline:
             }
 
         except Exception as e:
-            logger.error(f"Error processing audio query: {e}")
+            logger.error("Error processing audio query: %s", e)
             return None
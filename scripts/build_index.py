@@ -0,0 +1,28 @@
+"""
+Build the diseases FAISS index and its relevance threshold ahead of time into
+the index cache, so the app finds both at startup instead of encoding anything.
+
+Run from the repository root:
+    python -m scripts.build_index
+"""
+import argparse
+import logging
+from medical_rag import MedicalRAGPipeline
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the diseases FAISS index")
+    parser.add_argument("--diseases", default="diseases.json", help="Path to the diseases data file")
+    parser.add_argument("--intents", default="intents.json", help="Path to the intents data file")
+    args = parser.parse_args()
+
+    pipeline = MedicalRAGPipeline()
+    documents = pipeline.load_diseases_data(args.diseases)
+    # Both are written under INDEX_CACHE_DIR, keyed like the app's lookup
+    pipeline.create_index(documents)
+    pipeline.calibrate_relevance(pipeline.load_intents_data(args.intents))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Export the sentence embedding model to ONNX and quantize it to int8 for the
+VNNI / dot-product instructions of the target CPU.
+
+Run from the repository root:
+    python -m scripts.export_onnx
+"""
+import argparse
+import logging
+import os
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+from medical_rag import ONNX_DIR
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_CONFIGS = {
+    'avx512_vnni': AutoQuantizationConfig.avx512_vnni,
+    'avx2': AutoQuantizationConfig.avx2,
+    'arm64': AutoQuantizationConfig.arm64,
+}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export an int8 ONNX sentence encoder")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2", help="sentence-transformers model name")
+    parser.add_argument(
+        "--arch", default="avx512_vnni", choices=sorted(QUANTIZATION_CONFIGS),
+        help="CPU instruction set to quantize for"
+    )
+    args = parser.parse_args()
+
+    output_dir = os.path.join(ONNX_DIR, args.model)
+    model_id = f"sentence-transformers/{args.model}"
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_id).save_pretrained(output_dir)
+
+    # Dynamic quantization: int8 weights, activations quantized at run time
+    # Name the input, re-runs would otherwise find model_int8.onnx next to it and refuse to pick
+    quantizer = ORTQuantizer.from_pretrained(output_dir, file_name="model.onnx")
+    quantizer.quantize(
+        save_dir=output_dir,
+        quantization_config=QUANTIZATION_CONFIGS[args.arch](is_static=False, per_channel=False),
+        file_suffix="int8"
+    )
+    logger.info(f"Exported int8 ONNX model for {args.arch} to {output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import diskcache
+import soundfile as sf
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import wave
+import logging
+from typing import Any, BinaryIO, Iterator, List, Union
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "pyttsx3" renders offline, "gtts" calls the Google Translate endpoint
+TTS_BACKEND = os.getenv("TTS_BACKEND", "pyttsx3").lower()
+AUDIO_FORMAT = 'audio/wav' if TTS_BACKEND == 'pyttsx3' else 'audio/mp3'
+
+# "whisper" transcribes locally with an int8 model, "vosk" recognizes locally
+# while recording is still in progress, "google" uses the web API
+ASR_BACKEND = os.getenv("ASR_BACKEND", "whisper").lower()
+ASR_MODEL = os.getenv("ASR_MODEL", "base.en")
+# Path to a Vosk model directory; the small English model is downloaded when unset
+VOSK_MODEL = os.getenv("VOSK_MODEL")
+
+# Rendered audio is cached on disk, keyed by a hash of the text
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".tts_cache")
+_tts_cache = diskcache.Cache(TTS_CACHE_DIR, size_limit=2**30)
+
+# gTTS is network bound, so sentences are synthesized concurrently
+MAX_TTS_WORKERS = 8
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+def split_sentences(text: str) -> List[str]:
+    """Split text on sentence boundaries, dropping empty pieces"""
+    return [sentence for sentence in _SENTENCE_RE.split(text.strip()) if sentence.strip()]
+
+def _synthesize_sentence(sentence: str) -> bytes:
+    """Render a single sentence to MP3 bytes with gTTS"""
+    # Backends are imported on first use so only the configured one has to be installed
+    from gtts import gTTS
+
+    buffer = io.BytesIO()
+    gTTS(text=sentence, lang='en').write_to_fp(buffer)
+    return buffer.getvalue()
+
+# pyttsx3 drivers keep process-wide state (espeak has a single synth callback),
+# so one long-lived thread owns the only engine and renders jobs in order
+_tts_jobs = queue.Queue()
+_tts_worker = None
+_tts_worker_lock = threading.Lock()
+
+def _tts_loop() -> None:
+    """Create the engine once, then render (text, path, future) jobs from the queue"""
+    try:
+        import pyttsx3
+        engine = pyttsx3.init()
+        init_error = None
+    except Exception as e:
+        logger.error(f"Error initializing pyttsx3: {e}")
+        engine, init_error = None, e
+
+    while True:
+        text, path, future = _tts_jobs.get()
+        if engine is None:
+            future.set_exception(init_error)
+            continue
+        try:
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+
+def _synthesize_offline(text: str) -> bytes:
+    """Render text to WAV bytes locally with pyttsx3"""
+    global _tts_worker
+    with _tts_worker_lock:
+        if _tts_worker is None:
+            _tts_worker = threading.Thread(target=_tts_loop, name='pyttsx3', daemon=True)
+            _tts_worker.start()
+
+    # pyttsx3 can only render to a file
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_file = os.path.join(temp_dir, "speech.wav")
+        future = Future()
+        _tts_jobs.put((text, temp_file, future))
+        future.result()
+        with open(temp_file, 'rb') as f:
+            return f.read()
+
+def iter_speech_chunks(text: str) -> Iterator[bytes]:
+    """
+    Synthesize text with gTTS sentence by sentence and yield the MP3 chunks in order
+    as soon as each one is ready
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return
+    with ThreadPoolExecutor(max_workers=min(MAX_TTS_WORKERS, len(sentences))) as executor:
+        yield from executor.map(_synthesize_sentence, sentences)
+
+def _synthesize(text: str) -> bytes:
+    """
+    Convert text to audio bytes with the configured backend, WAV for pyttsx3
+    and MP3 for gTTS (MP3 frames concatenate cleanly)
+    """
+    if TTS_BACKEND == 'pyttsx3':
+        return _synthesize_offline(text)
+    return b"".join(iter_speech_chunks(text))
+
+def join_audio(chunks: List[bytes]) -> bytes:
+    """Concatenate clips produced by synthesize_speech into a single clip"""
+    if TTS_BACKEND != 'pyttsx3' or not chunks:
+        return b"".join(chunks)
+
+    # Every WAV clip carries its own header, so copy the frames into one file
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as writer:
+        for i, chunk in enumerate(chunks):
+            with wave.open(io.BytesIO(chunk), 'rb') as reader:
+                if i == 0:
+                    writer.setparams(reader.getparams())
+                writer.writeframes(reader.readframes(reader.getnframes()))
+    return output.getvalue()
+
+def synthesize_speech(text: str) -> bytes:
+    """
+    Convert text to audio bytes, reusing audio rendered before from the disk cache
+    (the app keeps its own in-memory copies with st.cache_data)
+    """
+    # The backend is part of the key since it decides the audio container
+    key = hashlib.blake2b(f"{TTS_BACKEND}:{text}".encode('utf-8')).hexdigest()
+    audio_bytes = _tts_cache.get(key)
+    if audio_bytes is None:
+        audio_bytes = _synthesize(text)
+        _tts_cache[key] = audio_bytes
+    return audio_bytes
+
+@lru_cache(maxsize=1)
+def get_asr_model() -> Any:
+    """Load the int8 quantized Whisper model once per process"""
+    from faster_whisper import WhisperModel
+    return WhisperModel(ASR_MODEL, device="cpu", compute_type="int8")
+
+def transcribe_local(audio: Union[str, BinaryIO]) -> str:
+    """Transcribe an audio file or file-like object with the local Whisper model"""
+    segments, _ = get_asr_model().transcribe(audio, beam_size=1, vad_filter=True)
+    return " ".join(segment.text.strip() for segment in segments).strip()
+
+@lru_cache(maxsize=1)
+def get_vosk_model() -> Any:
+    """Load the Vosk model once per process"""
+    from vosk import Model
+    return Model(VOSK_MODEL) if VOSK_MODEL else Model(lang="en-us")
+
+def new_stream_recognizer(sample_rate: int) -> Any:
+    """Create a Vosk recognizer that is fed 16-bit mono PCM as it is captured"""
+    from vosk import KaldiRecognizer
+    return KaldiRecognizer(get_vosk_model(), sample_rate)
+
+def finish_stream(recognizer: Any) -> str:
+    """Flush a stream recognizer and return the text of everything it was fed"""
+    return json.loads(recognizer.FinalResult()).get('text', '').strip()
+
+def transcribe_vosk(audio: Union[str, BinaryIO]) -> str:
+    """Transcribe a complete audio file or file-like object with Vosk"""
+    data, sample_rate = sf.read(audio, dtype='int16')
+    if data.ndim > 1:
+        data = data[:, 0]
+    recognizer = new_stream_recognizer(sample_rate)
+    recognizer.AcceptWaveform(data.tobytes())
+    return finish_stream(recognizer)